@@ -13,6 +13,8 @@ import sys;
 
 print("RUNNING: ", "in/"+sys.argv[1])
 D_TYPE = PETSc.ScalarType
+# compile the generated element kernels with full optimisation for the host CPU
+JIT_OPTIONS = {"cffi_extra_compile_args": ["-O3", "-march=native"]}
 
 ν = 0.43
 E = 1.8e9
@@ -32,31 +34,33 @@ def build_nullspace(V: fem.VectorFunctionSpace):
     bs = V.dofmap.index_map_bs;
     length0 = V.dofmap.index_map.size_local;
     length1 = length0 + V.dofmap.index_map.num_ghosts;
-    basis = [np.zeros(bs * length1, dtype = D_TYPE) for i in range(6)];
-    
-    # Get dof indices for each subspace (x, y and z dofs)
-    dofs = [V.sub(i).dofmap.list.array for i in range(3)];
+    # The dofs of the blocked space are ordered (node, component), so each
+    # mode is filled through a (node, component) view and every entry is
+    # written exactly once, without zero-initialisation or dof gathering
+    basis = np.empty((6, length1, bs), dtype = D_TYPE);
+    x = V.tabulate_dof_coordinates();
+    x0, x1, x2 = x[:, 0], x[:, 1], x[:, 2];
     
     # Set the three translational rigid body modes
-    for i in range(3):
-        basis[i][dofs[i]] = 1.0;
+    basis[:3] = np.eye(3, dtype = D_TYPE)[:, None, :];
     
     # Set the three rotational rigid body modes
-    x = V.tabulate_dof_coordinates();
-    dofs_block = V.dofmap.list.array;
-    x0, x1, x2 = x[dofs_block, 0], x[dofs_block, 1], x[dofs_block, 2];
-    
-    basis[3][dofs[0]] = -x1;
-    basis[3][dofs[1]] = x0;
-    basis[4][dofs[0]] = x2;
-    basis[4][dofs[2]] = -x0;
-    basis[5][dofs[2]] = x1;
-    basis[5][dofs[1]] = -x2;
+    basis[3, :, 0] = -x1;
+    basis[3, :, 1] = x0;
+    basis[3, :, 2] = 0.0;
+    basis[4, :, 0] = x2;
+    basis[4, :, 1] = 0.0;
+    basis[4, :, 2] = -x0;
+    basis[5, :, 0] = 0.0;
+    basis[5, :, 1] = -x2;
+    basis[5, :, 2] = x1;
+    basis = basis.reshape(6, bs * length1);
     
     # Create PETSc Vec objects (excluding ghosts) and normalise
-    basis_petsc = [PETSc.Vec().createWithArray(x[:bs*length0], bsize=3, comm=V.mesh.comm) for x in basis]
+    # (rows of the C-contiguous basis array are wrapped without copying)
+    basis_petsc = [PETSc.Vec().createWithArray(basis[k, :bs*length0], bsize=3, comm=V.mesh.comm) for k in range(6)]
     la.orthonormalize(basis_petsc);
-    assert la.is_orthonormal(basis_petsc);
+    assert la.is_orthonormal(basis_petsc, eps = max(1.0e-12, 1.0e3*np.finfo(D_TYPE).eps));
     
     #Create and return a PETSc nullspace
     return PETSc.NullSpace().create(vectors=basis_petsc);
@@ -105,6 +109,9 @@ def main():
 
     ORDER = 2
 
+    # Multigrid preconditioner: "hypre" (BoomerAMG) or "gamg"
+    PRECONDITIONER = "hypre"
+
     
     ## Setting up gmsh properties
     gmsh.initialize()
@@ -131,45 +138,41 @@ def main():
 
     # Set the usage of hexahedron elements 
     gmsh.option.setNumber("Mesh.SubdivisionAlgorithm", 0)
-    ## Importing RVE geometry
-    gmsh.open("in/"+sys.argv[1]);
-
+    comm = MPI.COMM_WORLD;
+    # The RVE is read by gmsh on rank 0 only and distributed by gmshio
     model = gmsh.model()
-    # model.add("main_domain")
-    model_name = model.getCurrent()
-    tags = [dimtag[1] for dimtag in model.get_entities(3)]
+    bbox = None;
+    if comm.rank == 0:
+        ## Importing RVE geometry
+        gmsh.open("in/"+sys.argv[1]);
+
+        # model.add("main_domain")
+        model_name = model.getCurrent()
+        tags = [dimtag[1] for dimtag in model.get_entities(3)]
 
-    model.add_physical_group(dim=3, tags=tags)
+        model.add_physical_group(dim=3, tags=tags)
 
 
-    # Synchronize OpenCascade representation with gmsh model
-    model.occ.synchronize()
+        # Synchronize OpenCascade representation with gmsh model
+        model.occ.synchronize()
 
 
-    # Generate the mesh
-    # model.mesh.generate(2)
-    # model.mesh.recombine()
-    # model.mesh.generate(dim=3)
+        # Generate the mesh
+        # model.mesh.generate(2)
+        # model.mesh.recombine()
+        # model.mesh.generate(dim=3)
 
-    bbox = [np.Inf,
-            np.Inf,
-            np.Inf,
-            -np.Inf,
-            -np.Inf,
-            -np.Inf]
-    for tag in tags:
-        buf_bbox = model.get_bounding_box(3, tag)
-        for i in range(3):
-            if bbox[i] > buf_bbox[i]:
-                bbox[i] = buf_bbox[i]
-        for j in range(3,6):
-            if bbox[j] < buf_bbox[j]:
-                bbox[j] = buf_bbox[j]
+        # Overall bounding box of all volumes: (xmin, ymin, zmin, xmax, ymax, zmax)
+        bbs = np.array([model.get_bounding_box(3, tag) for tag in tags]);
+        bbox = np.empty(6);
+        bbox[:3] = bbs[:, :3].min(axis = 0);
+        bbox[3:] = bbs[:, 3:].max(axis = 0);
+    bbox = comm.bcast(bbox, root = 0);
 
 
-    # Create a DOLFINx mesh (same mesh on each rank)
-    # print("MPI.COMM_SELF====",MPI.COMM_SELF)
-    msh, cell_markers, facet_markers = gmshio.model_to_mesh(model, MPI.COMM_WORLD,0)
+    # Create a DOLFINx mesh partitioned across the ranks
+    msh, cell_markers, facet_markers = gmshio.model_to_mesh(model, comm, 0,
+                                                            partitioner=mesh.create_cell_partitioner(mesh.GhostMode.shared_facet))
     # msh, cell_markers, facet_markers = gmshio.read_from_msh("in/"+sys.argv[1], MPI.COMM_WORLD, 0, gdim=3)
     msh.name = "Box"
     cell_markers.name = f"{msh.name}_cells"
@@ -191,8 +194,8 @@ def main():
     u = ufl.TrialFunction(V)
     v = ufl.TestFunction(V)
     f = fem.Constant(msh, PETSc.ScalarType((0., 0., 0.)))
-    a = fem.form(ufl.inner(sigma(u), epsilon(v)) * ufl.dx(metadata={"quadrature_degree": ORDER}))
-    L = fem.form(ufl.dot(f, v) * ufl.dx(metadata={"quadrature_degree": ORDER})) #+ ufl.dot(T, v) * ds
+    a = fem.form(ufl.inner(sigma(u), epsilon(v)) * ufl.dx(metadata={"quadrature_degree": ORDER}), jit_options=JIT_OPTIONS)
+    L = fem.form(ufl.dot(f, v) * ufl.dx(metadata={"quadrature_degree": ORDER}), jit_options=JIT_OPTIONS) #+ ufl.dot(T, v) * ds
     
     eps = np.linalg.norm(np.array(bbox[0:3]) + np.array(bbox[3:]));
     
@@ -200,96 +203,86 @@ def main():
     
     fdim = msh.topology.dim - 1
     
+    # same tolerance as np.isclose(x, bbox, atol = eps), evaluated once per face;
+    # it is loose (the gmsh bounding box is not tight on the RVE faces), so it is
+    # only applied to exterior facets and never to interior dof coordinates
+    tol = eps + 1.0e-5*np.abs(bbox);
+
     def left(x):
-        return np.isclose(x[0], bbox[0], atol = eps);
+        return np.abs(x[0] - bbox[0]) <= tol[0];
 
     def right(x):
-        return np.isclose(x[0], bbox[3], atol = eps);
+        return np.abs(x[0] - bbox[3]) <= tol[3];
 
     def bottom(x):
-        return np.isclose(x[2], bbox[2], atol = eps);
+        return np.abs(x[2] - bbox[2]) <= tol[2];
 
     def top(x):
-        return np.isclose(x[2], bbox[5], atol = eps);
+        return np.abs(x[2] - bbox[5]) <= tol[5];
 
     def front(x):
-        return np.isclose(x[1], bbox[1], atol = eps);
+        return np.abs(x[1] - bbox[1]) <= tol[1];
 
     def back(x):
-        return np.isclose(x[1], bbox[4], atol = eps);
+        return np.abs(x[1] - bbox[4]) <= tol[4];
 
-    def KUBC(x, i, j, ud):
-        values = np.zeros(x.shape);
+    def on_faces(x):
+        return left(x) | right(x) | bottom(x) | top(x) | front(x) | back(x);
 
-        values[i,:] += 0.5*ud*(x[j])/(bbox[j+3] - bbox[j]);
-        values[j,:] += 0.5*ud*(x[i])/(bbox[i+3] - bbox[i]);
+    def KUBC(i, j, ud):
+        """returns the matrix A of the affine KUBC displacement u = A @ x for the (i, j) load case"""
+        A = np.zeros((3, 3));
 
-        return values;
-    
-    # find all facets on top, bottom and left boundary
-    left_facets = mesh.locate_entities_boundary(msh, fdim, left);
-    right_facets = mesh.locate_entities_boundary(msh, fdim, right);
-    bottom_facets = mesh.locate_entities_boundary(msh, fdim, bottom);
-    top_facets = mesh.locate_entities_boundary(msh, fdim, top);
-    front_facets = mesh.locate_entities_boundary(msh, fdim, front);
-    back_facets = mesh.locate_entities_boundary(msh, fdim, back);
-    
-    marked_facets = np.hstack([left_facets, 
-                               right_facets, 
-                               bottom_facets,
-                               top_facets,
-                               front_facets,
-                               back_facets,
-                              ]);
-
-    markers = np.hstack([np.full_like(left_facets, 1),
-                         np.full_like(right_facets, 2),
-                         np.full_like(bottom_facets, 3),
-                         np.full_like(top_facets, 4),
-                         np.full_like(front_facets, 5),
-                         np.full_like(back_facets, 6),
-                        ]);
-
-    facets_order = np.argsort(marked_facets);
-
-    facets_tags = mesh.meshtags(msh, 
-                                fdim, 
-                                marked_facets[facets_order],
-                                markers[facets_order]);
-
-    ds = ufl.Measure('ds', domain=msh, subdomain_data=facets_tags, metadata={'quadrature_degree': ORDER});
+        A[i, j] += 0.5*ud/(bbox[j+3] - bbox[j]);
+        A[j, i] += 0.5*ud/(bbox[i+3] - bbox[i]);
+
+        return A;
     
     
     m_σ = np.zeros((6,6), dtype = np.float64);
     m_ε = np.zeros((6,6), dtype = np.float64);
     
     dx = ufl.Measure('dx', domain=msh, metadata={'quadrature_degree': ORDER});
-    volume = fem.assemble_scalar(fem.form(fem.Constant(msh, PETSc.ScalarType(1.0)) * dx()));
+    volume = comm.allreduce(fem.assemble_scalar(fem.form(fem.Constant(msh, PETSc.ScalarType(1.0)) * dx())), op = MPI.SUM);
     
     # set solver options
     opts = PETSc.Options();
-    # set gamg options
-    opts["ksp_type"] = "cg";
-    opts["ksp_rtol"] = 1.0e-7;
-    opts["pc_type"] = "gamg"; # geometric algebraic multigrid preconditioner
-
-    # Use Chebyshev smothing for multigrid
-    opts["mg_levels_ksp_type"] = "chebyshev";
-    opts["mg_levels_pc_type"] = "jacobi";
-
-    # Improve estimation of eigenvalues for Chebyshev smoothing
-    opts["mg_levels_esteig_ksp_type"] = "cg";
-    opts["mg_levels_ksp_chebyshev_esteig_steps"] = 20;
-    
-    # set hypre options
-#     opts["ksp_type"] = "cg";
-#     opts["ksp_rtol"] = 1.0e-7;
-#     opts["pc_type"] = "hypre"; # geometric algebraic multigrid preconditioner
-
-#     opts["pc_hypre_type"] = "boomeramg";
-#     opts["pc_hypre_boomeramg_max_iter"] = 1;
-#     opts["pc_hypre_boomeramg_cycle_type"] = "v";
-#     opts["pc_hypre_boomeramg_print_statistics"] = 1;
+    # pipelined CG overlaps the global reductions with the matrix-vector product
+    opts["ksp_type"] = "pipecg";
+    # the tolerance can not go below the round-off of the PETSc scalar type
+    # (e.g. when running with a single precision PETSc build)
+    opts["ksp_rtol"] = max(1.0e-7, 10*np.finfo(D_TYPE).eps);
+    if PRECONDITIONER == "hypre":
+        # set hypre options
+        opts["pc_type"] = "hypre"; # algebraic multigrid preconditioner
+        opts["pc_hypre_type"] = "boomeramg";
+
+        # Coarsen the 3 displacement dofs of each node together and use the
+        # rigid body near-nullspace in the interpolation
+        opts["pc_hypre_boomeramg_nodal_coarsen"] = 6;
+        opts["pc_hypre_boomeramg_vec_interp_variant"] = 3;
+        opts["pc_hypre_boomeramg_strong_threshold"] = 0.5;
+        opts["pc_hypre_boomeramg_interp_type"] = "ext+i";
+    else:
+        # set gamg options
+        opts["pc_type"] = "gamg"; # geometric algebraic multigrid preconditioner
+
+        # Aggressive coarsening on the first two levels and smoothed aggregation
+        # to get fewer and smaller coarse grids
+        opts["pc_gamg_aggressive_coarsening"] = 2;
+        opts["pc_gamg_threshold"] = 0.02;
+        opts["pc_gamg_threshold_scale"] = 0.5;
+        opts["pc_gamg_agg_nsmooths"] = 1;
+        # Reduce the coarse grids to fewer processes once they are small
+        opts["pc_gamg_process_eq_limit"] = 1000;
+
+        # Use Chebyshev smothing for multigrid
+        opts["mg_levels_ksp_type"] = "chebyshev";
+        opts["mg_levels_pc_type"] = "jacobi";
+
+        # Improve estimation of eigenvalues for Chebyshev smoothing
+        opts["mg_levels_esteig_ksp_type"] = "cg";
+        opts["mg_levels_ksp_chebyshev_esteig_steps"] = 20;
 
     
     # Create PETSc Krylov solver and turn convergence monitoring on
@@ -298,33 +291,57 @@ def main():
     solver.setMonitor(lambda _, its, rnorm: print(f"Iteration: {its}, rel. residual: {rnorm}"));
     ns = build_nullspace(V);
     
+    # The Dirichlet dofs are the same for every load case, so the operator
+    # with the boundary conditions applied is assembled only once and the
+    # multigrid setup is reused for all the right hand sides
+    ub_ = fem.Function(V);
+    # the affine KUBC map u = A x is evaluated by a compiled expression,
+    # only the constant matrix A is updated for each load case
+    A_bc = fem.Constant(msh, np.zeros((3, 3), dtype = D_TYPE));
+    ub_expr = fem.Expression(ufl.dot(A_bc, ufl.SpatialCoordinate(msh)),
+                             V.element.interpolation_points(),
+                             jit_options=JIT_OPTIONS);
+    # locate the exterior facets on the RVE faces in a single boundary pass
+    # and constrain the dofs of these facets
+    nonbottom_facets = mesh.locate_entities_boundary(msh, fdim, on_faces);
+    nonbottom_dofs = fem.locate_dofs_topological(V, fdim, nonbottom_facets);
+    bc_ = fem.dirichletbc(ub_, nonbottom_dofs);
+
+    # use block (3x3) storage for gamg, the block size is taken from V.dofmap.index_map_bs;
+    # hypre works on AIJ matrices (which also carry the block size)
+    A = fem.petsc.create_matrix(a, "aij" if PRECONDITIONER == "hypre" else "baij");
+    fem.petsc.assemble_matrix(A, a, bcs=[bc_]);
+    A.assemble()
+    # the elasticity operator is symmetric positive definite
+    A.setOption(PETSc.Mat.Option.SYMMETRIC, True);
+    A.setOption(PETSc.Mat.Option.SPD, True);
+    A.setOption(PETSc.Mat.Option.SYMMETRY_ETERNAL, True);
+    A.setNearNullSpace(ns);
+
+    # Set matrix operator
+    solver.setOperators(A)
+    solver.setReusePreconditioner(True);
+
+    # the right hand side vector is allocated once and refilled for each load case
+    b = fem.petsc.create_vector(L);
+
     print("SOLVER IS SET UP")
     for i in range(3):
         for j in range(i,3):
 
-            ub_ = fem.Function(V);
-            full_bc = lambda x: KUBC(x, i,j, unit_disp);
-            ub_.interpolate(full_bc);
-            nonbottom_dofs = fem.locate_dofs_topological(V,
-                                                     facets_tags.dim,
-                                                     marked_facets);
-            bc_ = fem.dirichletbc(ub_, nonbottom_dofs);
-
-            A = fem.petsc.assemble_matrix(a, bcs=[bc_]);
-            A.assemble()
-            A.setNearNullSpace(ns);
-            
-            b = fem.petsc.assemble_vector(L);
+            # only the boundary values change between the load cases
+            A_bc.value[:] = KUBC(i, j, unit_disp);
+            ub_.interpolate(ub_expr);
+
+            with b.localForm() as b_loc:
+                b_loc.set(0.0);
+            fem.petsc.assemble_vector(b, L);
             fem.petsc.apply_lifting(b, [a], bcs=[[bc_]]);
             b.ghostUpdate(addv=PETSc.InsertMode.ADD, mode=PETSc.ScatterMode.REVERSE);
             fem.petsc.set_bc(b, [bc_])
             
             uh = fem.Function(V);
-            # Set matrix operator
-            solver.setOperators(A)
-            # Set a monitor, solve linear system and display the solver
-            # configuration
-            
+            # Solve linear system and display the solver configuration
             solver.solve(b, uh.vector);
             solver.view();
 
@@ -332,14 +349,15 @@ def main():
             uh.x.scatter_forward()
 
             for (k, case) in enumerate(["xx", "yy", "zz", "yz", "xz", "xy"]):
-                ϵ_i = fem.assemble_scalar(fem.form(strein2Voigt(epsilon(uh))[k]*dx)) / volume;
-                σ_i = fem.assemble_scalar(fem.form(stress2Voigt(sigma(uh))[k]*dx)) / volume;
+                ϵ_i = comm.allreduce(fem.assemble_scalar(fem.form(strein2Voigt(epsilon(uh))[k]*dx)), op = MPI.SUM) / volume;
+                σ_i = comm.allreduce(fem.assemble_scalar(fem.form(stress2Voigt(sigma(uh))[k]*dx)), op = MPI.SUM) / volume;
                 m_σ[indexVoigt(i, j), k] = σ_i;
                 m_ε[indexVoigt(i, j), k] = ϵ_i;
                 print("ε{} = {}; σ{} = {} ".format(case, ϵ_i, case, σ_i));
     
     
-    np.savetxt("out/"+sys.argv[1], np.vstack((m_ε,m_σ)) , delimiter = ", ")
+    if comm.rank == 0:
+        np.savetxt("out/"+sys.argv[1], np.vstack((m_ε,m_σ)) , delimiter = ", ")
     # np.savetxt("out/", m_σ, delimiter = ", ");    
     
     